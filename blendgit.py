@@ -31,8 +31,10 @@
 import os
 import time
 import itertools
+import functools
 import subprocess
-import errno
+import threading
+import concurrent.futures
 import shutil
 import bpy
 
@@ -53,12 +55,21 @@ bl_info = \
 
 hide_git_dir = True
 OS = "linux"  # linux, win, mac
+git_exe = shutil.which("git") or "git"
+  # full path (and not specifying cwd) lets subprocess use the faster
+  # posix_spawn where available, when close_fds is also false
 
-def format_compact_datetime(timestamp) :
+def format_compact_datetime(timestamp, now = None, now_items = None) :
     # returns as brief as possible a human-readable display of the specified date/time.
+    # now and now_items can be passed in when formatting many timestamps at once,
+    # to avoid recomputing them each time.
     then_items = time.localtime(timestamp)
-    now = time.time()
-    now_items = time.localtime(now)
+    if now == None :
+        now = time.time()
+    #end if
+    if now_items == None :
+        now_items = time.localtime(now)
+    #end if
     if abs(now - timestamp) < 86400 :
         format = "%H:%M:%S"
     else :
@@ -77,88 +88,325 @@ def doc_saved() :
 #end doc_saved
 
 
-def get_repo_name() :
-    # name to use for the repo associated with this doc
+@functools.lru_cache(maxsize = 4)
+def repo_name_for(filepath) :
+    # name to use for the repo associated with the doc at the specified path.
+    # Cached, since this only changes when a different doc is opened or saved.
     if hide_git_dir:
         if OS == "linux" or OS == "mac":
-            path_split = bpy.data.filepath.split("/")
+            path_split = filepath.split("/")
             return "/".join(path_split[:-1]) + "/." + path_split[-1] + ".git"
         else:
             # Windows, Can't set it as hidden until it's created
             # so do it after we use git init to create dir when saving
-            return bpy.data.filepath + ".git"
+            return filepath + ".git"
     else:
-        return bpy.data.filepath + ".git"
+        return filepath + ".git"
+#end repo_name_for
+
+def get_repo_name() :
+    # name to use for the repo associated with this doc
+    return repo_name_for(bpy.data.filepath)
 #end get_repo_name
 
-def get_workdir_name() :
-    # name to use for a temporary source tree directory for making commits to the repo
-    return bpy.data.filepath + ".work"
-#end get_workdir_name
+def do_git(args, stream = False, input = None, doc_path = None, work_tree = True) :
+    # common routine for invoking various Git functions. If stream, then
+    # the running process is returned, so the caller can read its output
+    # incrementally from stdout; the caller is responsible for closing
+    # this and waiting for the process to terminate. Otherwise, input
+    # if specified is fed to the process as its stdin. doc_path must be
+    # specified when calling from a thread other than Blender’s main one,
+    # which is not allowed to access bpy. work_tree indicates whether to
+    # tell Git where the work tree is.
+    if doc_path == None :
+        doc_path = bpy.data.filepath
+    #end if
+    # use parent directory of .blend file as work dir
+    work_dir = os.path.split(doc_path)[0]
+    git_args = (git_exe, "-C", work_dir, "--git-dir=" + repo_name_for(doc_path))
+    if work_tree :
+        git_args += ("--work-tree=" + work_dir,)
+    #end if
+    args = git_args + args
+    if stream :
+        result = subprocess.Popen \
+          (
+            args = args,
+            stdin = subprocess.DEVNULL,
+            stdout = subprocess.PIPE,
+            shell = False
+              # leave close_fds at its default, since this process runs in
+              # the background alongside Blender for an unbounded time
+          )
+    else :
+        if input == None :
+            stdin = {"stdin" : subprocess.DEVNULL}
+        else :
+            stdin = {"input" : input}
+        #end if
+        result = subprocess.check_output \
+          (
+            args = args,
+            shell = False,
+            close_fds = False,
+              # faster to spawn, at the cost of letting Git inherit any fds that
+              # Blender or its libraries opened without O_CLOEXEC. Acceptable
+              # because these processes are short-lived and run to completion
+              # while Blender waits.
+            **stdin
+          )
+    #end if
+    return \
+        result
+#end do_git
 
-def setup_workdir() :
-    # creates a temporary work directory in which .git points to the actual
-    # repo directory.
-    work_dir = get_workdir_name()
-    try :
-        os.mkdir(work_dir)
-    except OSError as why :
-        if why.errno != errno.EEXIST :
-            raise
+min_paths_per_hash_worker = 32
+
+def commit_files(paths, message) :
+    # makes a new commit on the current branch in which the specified files,
+    # with paths relative to the parent directory of the .blend file, are
+    # updated to their current contents. This is done with low-level Git
+    # plumbing commands straight from the original files, so there is no
+    # need to assemble them in a separate work tree first. Returns False,
+    # without making a commit, if nothing has changed since the last one.
+
+    def hash_files(paths) :
+        return \
+            do_git \
+              (
+                ("hash-object", "-w", "--no-filters", "--stdin-paths"),
+                input = b"".join(os.fsencode(path) + b"\n" for path in paths),
+                doc_path = doc_path
+              ).decode("utf-8").split()
+    #end hash_files
+
+    def file_mode(path) :
+        # keeps the executable bit, like “git add” does where core.filemode is true
+        # (i.e. other than on Windows).
+        if os.name != "nt" and os.stat(os.path.join(parent_dir, path)).st_mode & 0o111 != 0 :
+            result = b"100755"
+        else :
+            result = b"100644"
         #end if
-    #end try
-    os.symlink("../" + os.path.basename(get_repo_name()), os.path.join(work_dir, ".git"))
-      # must be a symlink because it might not initially exist
-#end setup_workdir
-
-def cleanup_workdir() :
-    # gets rid of the temporary work directory.
-    shutil.rmtree(get_workdir_name())
-#end cleanup_workdir
-
-def do_git(args, saving = False) :
-    # common routine for invoking various Git functions.
-    env = dict(os.environ)
-    if saving :
-        # assume setup_workdir has been called
-        env.pop("GIT_DIR", None)
-        # Cannot use GIT_DIR, as that creates a bare repo, which cannot be committed to.
-        work_dir = get_workdir_name()
+        return result
+    #end file_mode
+
+#begin commit_files
+    doc_path = bpy.data.filepath
+    parent_dir = os.path.split(doc_path)[0]
+    # Hashing and compressing the file contents is the expensive part, and
+    # each object is written independently, so spread it over several processes.
+    # But only if there are enough files to be worth the extra process spawns;
+    # small saves are done with just one.
+    nr_workers = max(min(8, os.cpu_count() or 1, len(paths) // min_paths_per_hash_worker), 1)
+    chunk_size = (len(paths) + nr_workers - 1) // nr_workers
+    with concurrent.futures.ThreadPoolExecutor(max_workers = nr_workers) as executor :
+        blobs = list \
+          (
+            itertools.chain.from_iterable
+              (
+                executor.map
+                  (
+                    hash_files,
+                    (paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size))
+                  )
+              )
+          )
+    #end with
+    do_git \
+      (
+        ("update-index", "--add", "-z", "--index-info"),
+        input = b"".join
+          (
+            b"%s %s\t%s\0"
+            %
+                (
+                    file_mode(path),
+                    blob.encode("ascii"),
+                    os.fsencode(path.replace(os.sep, "/")),
+                )
+            for path, blob in zip(paths, blobs)
+          )
+      )
+    tree = do_git(("write-tree",)).decode("utf-8").strip()
+    parent, parent_tree = \
+        (
+            (lambda line : None if line.endswith(" missing") else line)(line)
+                # no commits yet
+            for line in do_git
+              (
+                ("cat-file", "--batch-check=%(objectname)"),
+                input = b"HEAD\nHEAD^{tree}\n"
+              ).decode("utf-8").split("\n")[:2]
+        )
+    if tree != parent_tree :
+        commit_args = ("commit-tree", tree, "-m", message)
+        if parent != None :
+            commit_args += ("-p", parent)
+        #end if
+        commit = do_git(commit_args).decode("utf-8").strip()
+        update_args = ("update-ref", "-m", "commit: " + message.split("\n", 1)[0], "HEAD", commit)
+        if parent != None :
+            update_args += (parent,) # guard against concurrent update
+        #end if
+        do_git(update_args)
+        committed = True
     else :
-        # assume repo already exists, use parent directory of .blend file as work dir
-        work_dir = os.path.split(bpy.data.filepath)[0]
-        env["GIT_DIR"] = get_repo_name()
+        # nothing changed since last commit
+        committed = False
     #end if
     return \
-        subprocess.check_output \
+        committed
+#end commit_files
+
+def read_records(stream, terminator) :
+    # generator which yields successive records delimited by the specified
+    # terminator from the binary stream, as soon as each one is complete.
+    pending = b""
+    while True :
+        block = stream.read1(65536)
+        if len(block) == 0 :
+            break
+        records = (pending + block).split(terminator)
+        pending = records.pop()
+        yield from records
+    #end while
+    if len(pending) != 0 :
+        yield pending
+    #end if
+#end read_records
+
+_commits_cache = {"loaded" : (None, None), "loading" : (None, None)}
+  # "loaded" is the key and parsed commit history from the last git log,
+  # so that menu redraws do not have to rerun it each time. "loading" is
+  # the key being loaded and the thread running git log in the background
+  # for it, if any. Each is a tuple so that it can be replaced in a single
+  # assignment, without other threads seeing a mismatched key and value.
+
+def load_commits(key, doc_path, max_commits) :
+    # runs git log and saves the parsed commit history in _commits_cache
+    # under the specified key. Called on a background thread, so must not
+    # access bpy.
+    commits = []
+    now = time.time()
+    now_items = time.localtime(now)
+    try :
+        proc = do_git \
           (
-            args = ("git",) + args,
-            stdin = subprocess.DEVNULL,
-            shell = False,
-            cwd = work_dir,
-            env = env
+            ("log", "-z", "--format=%H %ct %s", "-n", str(max_commits)),
+            stream = True,
+            doc_path = doc_path
           )
-#end do_git
+        try :
+            for record in read_records(proc.stdout, b"\0") :
+                if len(record) != 0 :
+                    # only the subject needs decoding as anything other than ASCII
+                    sha, timestamp, subject = record.split(b" ", 2)
+                    commits.append \
+                      (
+                        (
+                            sha.decode("ascii"),
+                            "%s: %s"
+                            %
+                                (
+                                    format_compact_datetime(int(timestamp), now, now_items),
+                                    subject.decode("utf-8", "replace"),
+                                ),
+                            "",
+                        )
+                      )
+                #end if
+            #end for
+        finally :
+            proc.stdout.close()
+            proc.wait()
+        #end try
+        if proc.returncode != 0 :
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        #end if
+    except (OSError, ValueError, subprocess.CalledProcessError) as fail :
+        commits = [("", "Cannot list commits: %s" % fail, "")]
+    #end try
+    _commits_cache["loaded"] = (key, commits)
+#end load_commits
+
+default_max_commits = 500
+
+def get_max_commits() :
+    # returns the user preference for the number of commits to list. Does not
+    # rely on the context passed to callbacks, which can be None, and allows
+    # for the add-on being run as a script, without registered preferences.
+    addon = bpy.context.preferences.addons.get(__name__)
+    if addon != None :
+        result = addon.preferences.max_commits
+    else :
+        result = default_max_commits
+    #end if
+    return result
+#end get_max_commits
+
+def commits_key() :
+    # returns a key identifying the state of the commit history to be listed,
+    # or None if there is no repo.
+    repo_name = get_repo_name()
+    if os.path.isdir(repo_name) :
+        result = \
+            (
+                repo_name,
+                get_max_commits(),
+                os.stat(os.path.join(repo_name, "HEAD")).st_mtime_ns,
+                os.stat(os.path.join(repo_name, "refs", "heads")).st_mtime_ns,
+                  # branch ref files are replaced by rename on each commit,
+                  # which updates the mtime of their containing directory
+            )
+    else :
+        result = None
+    #end if
+    return result
+#end commits_key
 
 def list_commits(self, context) :
     # generates the menu items showing the commit history for the user to pick from.
+    # If this is not already known, then it is loaded in the background, and a
+    # placeholder is returned in the meantime.
     global last_commits_list # docs say Python must keep ref to strings
-    repo_name = get_repo_name()
-    if os.path.isdir(repo_name) :
-        # Blender bug? Items in menu end up in reverse order from that in my list
-        last_commits_list = list \
-          (
-            (entry[0], "%s: %s" % (format_compact_datetime(int(entry[1])), entry[2]), "")
-                for line in do_git(("log", "--format=%H %ct %s")).decode("utf-8").split("\n")
-                if len(line) != 0
-                for entry in (line.split(" ", 2),)
-          )
+    key = commits_key()
+    if key != None :
+        loaded_key, loaded = _commits_cache["loaded"]
+        if loaded_key == key :
+            # Blender bug? Items in menu end up in reverse order from that in my list
+            last_commits_list = loaded
+        else :
+            loading_key, loading = _commits_cache["loading"]
+            if loading_key != key or not loading.is_alive() :
+                loading = threading.Thread \
+                  (
+                    target = load_commits,
+                    args = (key, bpy.data.filepath, key[1]),
+                    daemon = True
+                  )
+                _commits_cache["loading"] = (key, loading)
+                loading.start()
+            #end if
+            last_commits_list = [("", "(loading...)", ""),]
+        #end if
     else :
         last_commits_list = [("", "No repo found", ""),]
     #end if
     return last_commits_list
 #end list_commits
 
+def wait_commits(context) :
+    # makes sure the current commit history is fully loaded before it is shown.
+    while True :
+        key = commits_key()
+        if key == None or _commits_cache["loaded"][0] == key :
+            break
+        list_commits(None, context) # start loading current history if not already doing so
+        _commits_cache["loading"][1].join()
+    #end while
+#end wait_commits
+
 class LoadVersion(bpy.types.Operator) :
     bl_idname = "file.version_control_load"
     bl_label = "Load Version..."
@@ -176,6 +424,7 @@ class LoadVersion(bpy.types.Operator) :
 
     def invoke(self, context, event):
         if doc_saved() :
+            wait_commits(context)
             result = context.window_manager.invoke_props_dialog(self)
         else :
             self.report({"ERROR"}, "Need to save the new document first")
@@ -223,117 +472,99 @@ class SaveVersion(bpy.types.Operator) :
     def execute(self, context) :
 
         seen_filepaths = set()
-
-        def process_item(item) :
-            # common processing for all externally-referenceable item types
-            # other than nodes.
-            if item.filepath not in seen_filepaths :
-                seen_filepaths.add(item.filepath)
-                filepath = item.filepath[2:] # relative to .blend file
-                subparent_dir = os.path.split(filepath)[0]
-                if len(subparent_dir) != 0 :
-                    os.makedirs(os.path.join(work_dir, subparent_dir), exist_ok = True)
-                #end if
-                dst_path = os.path.join(work_dir, filepath)
-                  # keep relative path within work dir
-                try :
-                    os.link(os.path.join(parent_dir, filepath), dst_path)
-                      # must be a hard link, else git commits the symlink
-                except FileExistsError :
-                    # in case of multiple references to file
-                    pass
-                #end try
-                do_git(("add", "--", dst_path), saving = True)
-                  # Git will quietly ignore this if file hasn’t changed
+        seen_trees = set()
+        paths_to_add = []
+
+        def process_item(fp) :
+            # common processing for the filepath of all externally-referenceable
+            # item types.
+            if fp not in seen_filepaths :
+                seen_filepaths.add(fp)
+                paths_to_add.append(fp[2:]) # relative to .blend file
             #end if
         #end process_item
 
         def process_node(node) :
-            # looks for externally-referenced OSL scripts and IES parameters.
-            if node.node_tree != None :
-                for subnode in node.node_tree.nodes :
-                    if subnode.type == "GROUP" :
-                        # multiple references to a node group don’t matter,
-                        # since process_item (above) automatically skips
-                        # filepaths it has already seen.
-                        process_node(subnode)
-                    elif (
-                            isinstance
-                              (
-                                subnode,
-                                (bpy.types.ShaderNodeScript, bpy.types.ShaderNodeTexIES)
-                              )
-                        and
-                            subnode.mode == "EXTERNAL"
-                    ) :
-                        process_item(subnode)
-                    #end if
-                #end for
-            #end if
+            # looks for externally-referenced OSL scripts and IES parameters,
+            # using an explicit stack rather than recursion for node groups.
+            stack = [node]
+            while len(stack) != 0 :
+                node_tree = stack.pop().node_tree
+                if node_tree != None and node_tree.as_pointer() not in seen_trees :
+                    # node groups can be shared, so only need to look at each tree once.
+                    # Note Python wrapper objects for the same tree need not be identical.
+                    seen_trees.add(node_tree.as_pointer())
+                    for subnode in node_tree.nodes :
+                        subnode_type = subnode.type
+                        if subnode_type == "GROUP" :
+                            stack.append(subnode)
+                        elif subnode_type in ("SCRIPT", "TEX_IES") and subnode.mode == "EXTERNAL" :
+                            # ShaderNodeScript or ShaderNodeTexIES
+                            process_item(subnode.filepath)
+                        #end if
+                    #end for
+                #end if
+            #end while
         #end process_node
 
     #begin execute
         if len(self.comment.strip()) != 0 :
             repo_name = get_repo_name()
-            setup_workdir()
             if not os.path.isdir(repo_name) :
-                do_git(("init",), saving = True)
-                do_git(("config", "--unset", "core.worktree"), saving = True) # can get set for some reason
+                do_git(("init",), work_tree = False)
+                  # without --work-tree, so core.worktree does not get set
+                do_git(("config", "core.bare", "false"))
+                  # init assumed bare, but keep it usable with a work tree,
+                  # as with repos created by earlier versions
 
                 if OS == "win" and hide_git_dir:
-                    env = dict(os.environ)
                     subprocess.check_output \
                       (
                         args = ("attrib", "+h", repo_name),
                         stdin = subprocess.DEVNULL,
                         shell = False,
-                        cwd = os.path.dirname(repo_name),
-                        env = env
+                        cwd = os.path.dirname(repo_name)
                       )
             #end if
             bpy.ops.wm.save_as_mainfile("EXEC_DEFAULT", filepath = bpy.data.filepath)
-            parent_dir = os.path.split(bpy.data.filepath)[0]
-            work_dir = get_workdir_name()
-            os.link(bpy.data.filepath, os.path.join(work_dir, os.path.basename(bpy.data.filepath)))
-              # must be a hard link, else git commits the symlink
-            do_git(("add", "--", os.path.basename(bpy.data.filepath)), saving = True)
+            paths_to_add.append(os.path.basename(bpy.data.filepath))
             for \
-                category, match, mismatch \
+                collection, pred \
             in \
                 (
-                    ("fonts", {}, (("filepath", "<builtin>"),)),
-                    ("images", {"type" : "IMAGE"}, ()),
-                    ("libraries", {}, ()),
-                    ("sounds", {}, ()),
+                    (bpy.data.fonts, lambda item, fp : fp != "<builtin>"),
+                    (bpy.data.images, lambda item, fp : item.type == "IMAGE"),
+                    (bpy.data.libraries, None),
+                    (bpy.data.sounds, None),
                 ) \
             :
-                for item in getattr(bpy.data, category) :
+                for item in collection :
+                    fp = item.filepath
                     if (
-                            item.packed_file == None
-                              # not packed into .blend file
-                        and
-                            item.filepath.startswith("//")
+                            fp.startswith("//")
                               # must be relative to .blend file
                         and
-                            not item.filepath.startswith("//..")
+                            not fp.startswith("//..")
                               # must not be at higher level than .blend file
                         and
-                            not any(getattr(item, k) == v for k, v in mismatch)
+                            item.packed_file == None
+                              # not packed into .blend file
                         and
-                            all(getattr(item, k) == match[k] for k in match)
+                            (pred == None or pred(item, fp))
+                              # any category-specific condition
                     ) :
-                        process_item(item)
+                        process_item(fp)
                     #end if
                 #end for
             #end for
             for item in itertools.chain(bpy.data.materials, bpy.data.lights) :
                 process_node(item)
             #end for
-            for light in bpy.data.lights :
-                process_node(light)
-            #end for
-            do_git(("commit", "-m" + self.comment), saving = True)
-            cleanup_workdir()
+            if commit_files(paths_to_add, self.comment.strip()) :
+                _commits_cache["loaded"] = (None, None)
+            else :
+                self.report({"WARNING"}, "Nothing has changed since the last saved version")
+            #end if
             result = {"FINISHED"}
         else :
             self.report({"ERROR"}, "Comment cannot be empty")
@@ -344,6 +575,23 @@ class SaveVersion(bpy.types.Operator) :
 
 #end SaveVersion
 
+class BlendgitPreferences(bpy.types.AddonPreferences) :
+    bl_idname = __name__
+
+    max_commits : bpy.props.IntProperty \
+      (
+        name = "Max Commits Listed",
+        description = "maximum number of most recent commits to offer in the Load Version menu",
+        default = default_max_commits,
+        min = 1,
+      )
+
+    def draw(self, context) :
+        self.layout.prop(self, "max_commits")
+    #end draw
+
+#end BlendgitPreferences
+
 class VersionControlMenu(bpy.types.Menu) :
     bl_idname = "file.version_control_menu"
     bl_label = "Version Control"
@@ -362,6 +610,7 @@ def add_invoke_item(self, context) :
 
 _classes_ = \
     (
+        BlendgitPreferences,
         LoadVersion,
         SaveVersion,
         VersionControlMenu,